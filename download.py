@@ -6,8 +6,15 @@ import time
 import argparse
 from tqdm import tqdm
 import concurrent.futures
-import functools
-from processing import process_tarfile, ensure_dir
+import multiprocessing
+import threading
+from processing import process_tarfile, ensure_dir, views_reached_limit
+
+# Number of concurrent downloads in parallel mode
+DOWNLOAD_WORKERS = 4
+
+# Reuse connections across downloads from the same host
+_session = requests.Session()
 
 def sanitize_filename(name):
     """Replace special characters in filename with underscores"""
@@ -15,9 +22,9 @@ def sanitize_filename(name):
 
 def download_file(url, destination, position=0):
     """Download file to specified path with progress bar; display progress at given position"""
-    response = requests.get(url, stream=True)
+    response = _session.get(url, stream=True)
     total_size = int(response.headers.get('content-length', 0))
-    block_size = 1024  # 1 Kibibyte
+    block_size = 1024 * 128  # 128 Kibibytes
     
     with open(destination, 'wb') as file, tqdm(
             desc=os.path.basename(destination),
@@ -32,17 +39,15 @@ def download_file(url, destination, position=0):
             size = file.write(data)
             bar.update(size)
 
-def download_and_process_item(item, base_dir, frame_count=25, max_pairs=500):
+def prepare_item(item, base_dir):
     """
-    Download and process a single data item.
+    Resolve task name, task directory and local tar path for a single data item.
     :param item: A tuple (row, pos), where pos is the unique progress bar position.
     """
     row, pos = item
     task_name = row['task_name'].strip('"')
     url = row['url'].strip('"')
     
-    print(f"Processing task: {task_name} (position {pos})")
-    
     # Create task directory (handling special characters)
     sanitized_task_name = sanitize_filename(task_name)
     task_dir = os.path.join(base_dir, sanitized_task_name)
@@ -51,14 +56,60 @@ def download_and_process_item(item, base_dir, frame_count=25, max_pairs=500):
     # Download tar.gz file
     filename = os.path.basename(url)
     tar_path = os.path.join(".", filename)
+    return task_name, url, task_dir, tar_path
+
+def download_item(item, base_dir, max_pairs=500):
+    """
+    Download a single data item.
+    Returns (task_name, task_dir, tar_path), or None if the download failed or was skipped.
+    """
+    row, pos = item
+    task_name, url, task_dir, tar_path = prepare_item(item, base_dir)
+    
+    # Skip the download if the task already has enough pairs in every view (e.g. on a re-run)
+    if views_reached_limit(task_dir, max_pairs):
+        print(f"Skipping task: {task_name} (all views reached limit)")
+        return None
+    
+    print(f"Downloading task: {task_name} (position {pos})")
     
     try:
         # Download the file with assigned progress bar position
         download_file(url, tar_path, position=pos)
-        
-        # Process the downloaded tar file
+    except Exception as e:
+        print(f"Error downloading {task_name}: {e}")
+        # Clean up temporary files if needed
+        if os.path.exists(tar_path):
+            os.remove(tar_path)
+        return None
+    
+    return task_name, task_dir, tar_path
+
+def download_item_bounded(item, base_dir, slots, stop, max_pairs=500):
+    """
+    Download a single data item once a slot for a downloaded-but-unprocessed tar is free.
+    The slot is released here if nothing was downloaded, otherwise when processing finishes.
+    Gives up and returns None once stop is set (e.g. the processing pool broke).
+    """
+    while not slots.acquire(timeout=1):
+        if stop.is_set():
+            return None
+    if stop.is_set():
+        slots.release()
+        return None
+    try:
+        downloaded = download_item(item, base_dir, max_pairs)
+    except BaseException:
+        slots.release()
+        raise
+    if downloaded is None:
+        slots.release()
+    return downloaded
+
+def process_item(task_name, task_dir, tar_path, frame_count=25, max_pairs=500):
+    """Process a single downloaded tar file"""
+    try:
         process_tarfile(tar_path, task_name, task_dir, frame_count, max_pairs)
-        
     except Exception as e:
         print(f"Error processing {task_name}: {e}")
         # Clean up temporary files if needed
@@ -67,6 +118,20 @@ def download_and_process_item(item, base_dir, frame_count=25, max_pairs=500):
     
     return f"Completed: {task_name}"
 
+def download_and_process_item(item, base_dir, frame_count=25, max_pairs=500):
+    """
+    Download and process a single data item.
+    :param item: A tuple (row, pos), where pos is the unique progress bar position.
+    """
+    row, pos = item
+    downloaded = download_item(item, base_dir, max_pairs)
+    if downloaded is None:
+        task_name = row['task_name'].strip('"')
+        return f"Completed: {task_name}"
+    
+    task_name, task_dir, tar_path = downloaded
+    return process_item(task_name, task_dir, tar_path, frame_count, max_pairs)
+
 def process_dataset(csv_file, base_dir, frame_count=25, max_pairs=500, parallel=False):
     """Process the dataset based on the CSV file"""
     # Make sure the base directory exists
@@ -82,20 +147,58 @@ def process_dataset(csv_file, base_dir, frame_count=25, max_pairs=500, parallel=
     
     if parallel:
         print("Enabling parallel processing mode, processing multiple tasks concurrently...")
-        # Use ProcessPoolExecutor for parallel processing.
+        # Downloads run in a thread pool (network bound) and feed a process pool (CPU bound),
+        # so tar files are processed while the next ones are still downloading.
+        download_workers = DOWNLOAD_WORKERS
         max_workers = max(os.cpu_count() - 1, 1)
-        print(f"Using {max_workers} worker processes")
+        print(f"Using {download_workers} download threads and {max_workers} worker processes")
+        
+        # Limit how many tar files can sit on disk waiting to be processed
+        slots = threading.BoundedSemaphore(max_workers + download_workers)
+        
+        # Set when processing fails, so download threads waiting for a slot give up
+        stop = threading.Event()
+        
+        # Start workers via forkserver where available: forking while download threads hold
+        # stdout/tqdm/connection pool locks could leave those locks held forever in the child
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            mp_context = multiprocessing.get_context('forkserver')
+        else:
+            mp_context = None
         
-        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
-            # Note: functools.partial cannot fix the 'item' parameter here since it varies.
-            results = list(executor.map(
-                functools.partial(download_and_process_item, base_dir=base_dir, frame_count=frame_count, max_pairs=max_pairs),
-                items
-            ))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=download_workers) as downloader, \
+                concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context) as executor:
+            downloads = [downloader.submit(download_item_bounded, item, base_dir, slots, stop, max_pairs) for item in items]
             
-            # Print results
-            for result in results:
-                print(result)
+            try:
+                processing = []
+                for future in concurrent.futures.as_completed(downloads):
+                    downloaded = future.result()
+                    if downloaded is None:
+                        continue
+                    task_name, task_dir, tar_path = downloaded
+                    process_future = executor.submit(process_item, task_name, task_dir, tar_path, frame_count, max_pairs)
+                    process_future.add_done_callback(lambda _: slots.release())
+                    processing.append(process_future)
+                
+                # Print results
+                for future in concurrent.futures.as_completed(processing):
+                    print(future.result())
+            except BaseException:
+                # E.g. BrokenProcessPool after a worker died: stop downloading and wait for
+                # in-flight downloads so the pools can shut down instead of hanging
+                stop.set()
+                downloader.shutdown(wait=True, cancel_futures=True)
+                
+                # Remove tar files that were downloaded but never processed
+                for future in downloads:
+                    if future.cancelled() or future.exception() is not None or future.result() is None:
+                        continue
+                    tar_path = future.result()[2]
+                    if os.path.exists(tar_path):
+                        os.remove(tar_path)
+                        print(f"Removed {tar_path}")
+                raise
     else:
         # Sequential processing: iterate with assigned progress bar positions.
         for item in items:
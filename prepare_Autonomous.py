@@ -6,13 +6,15 @@ import h5py
 import numpy as np
 import json
 import cv2
-import glob
 import shutil
 from tqdm import tqdm
 import time
 import re
 import argparse
 
+# Reuse connections across downloads from the same host
+_session = requests.Session()
+
 def sanitize_filename(name):
     """Replace special characters in filename with underscores"""
     return re.sub(r'[^\w\-\.]', '_', name)
@@ -24,9 +26,9 @@ def ensure_dir(directory):
 
 def download_file(url, destination):
     """Download file to specified path with progress bar"""
-    response = requests.get(url, stream=True)
+    response = _session.get(url, stream=True)
     total_size = int(response.headers.get('content-length', 0))
-    block_size = 1024  # 1 Kibibyte
+    block_size = 1024 * 128  # 128 Kibibytes
     
     with open(destination, 'wb') as file, tqdm(
             desc=os.path.basename(destination),
@@ -39,53 +41,87 @@ def download_file(url, destination):
             size = file.write(data)
             bar.update(size)
 
+def open_sequential(path):
+    """Open a file for sequential reading and let the kernel read ahead while we decompress"""
+    # A 4 MiB userland buffer turns tarfile's small 10 KiB reads into few large read syscalls
+    f = open(path, 'rb', buffering=4 * 1024 * 1024)
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    return f
+
 def extract_tarfile(tar_path, extract_to='.'):
-    """Extract tar.gz file to specified directory and return the top level directory name"""
-    with tarfile.open(tar_path, 'r:gz') as tar:
-        tar.extractall(path=extract_to)
+    """Extract the .h5 files of a tar.gz file to specified directory and return the top level directory name"""
+    top_level_dir = None
+    # Single streaming pass: extract members and record the top level directory as we go.
+    # Only .h5 files are used downstream, so other payloads are skipped instead of written to disk.
+    with open_sequential(tar_path) as f, tarfile.open(fileobj=f, mode='r|gz') as tar:
+        for member in tar:
+            if top_level_dir is None and member.name != '.':
+                top_level_dir = member.name.split('/', 1)[0]
+            if member.isdir() or member.name.endswith('.h5'):
+                tar.extract(member, path=extract_to)
     
-    # Get the top level directory name
-    with tarfile.open(tar_path, 'r:gz') as tar:
-        top_level_dirs = {member.name.split('/')[0] for member in tar.getmembers() if member.name != '.'}
-        return list(top_level_dirs)[0] if top_level_dirs else None
+    # Make sure the top level directory exists even if none of its members were extracted
+    if top_level_dir:
+        os.makedirs(os.path.join(extract_to, top_level_dir), exist_ok=True)
+    return top_level_dir
 
 def find_h5_files(directory):
     """Find all .h5 files in the directory and its subdirectories"""
-    return glob.glob(os.path.join(directory, '**', '*.h5'), recursive=True)
+    # os.scandir gets names and types from the directory listing, without a stat per entry
+    h5_files = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            # Skip hidden entries like glob does (e.g. macOS AppleDouble '._Trial.h5' files)
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                h5_files.extend(find_h5_files(entry.path))
+            elif entry.name.endswith('.h5'):
+                h5_files.append(entry.path)
+    return h5_files
 
 def process_h5_file(h5_path, task_name, output_folder, frame_count=25):
     """Process a single h5 file, extract frames and generate videos"""
     print(f"Processing {h5_path}")
     
     base_filename = os.path.basename(h5_path).replace('.h5', '')
+    # Every JSON file of this task has the same content, so encode it once
+    json_payload = json.dumps({"0": task_name}).encode()
     
     try:
-        with h5py.File(h5_path, 'r') as file:
+        # Enlarge the chunk cache (default 1 MiB) so chunks of full-resolution frames stay cached
+        # while the sampled frames are read
+        with h5py.File(h5_path, 'r', rdcc_nbytes=256 * 1024 * 1024, rdcc_nslots=1000003, rdcc_w0=0.75) as file:
             # Check for Trial keys
             trials = sorted([k for k in file.keys() if 'Trial' in k], 
                            key=lambda x: int(x.replace('Trial', '')))
             
             for trial in trials:
-                if 'data' not in file[trial]:
+                # Single lookup instead of a membership test followed by indexing
+                data = file[trial].get('data')
+                if data is None:
                     continue
                 
-                data = file[trial]['data']
-                
                 # Check for RGB views
                 rgb_views = ['rgb_left', 'rgb_right', 'rgb_top', 'rgb_wrist']
                 for view in rgb_views:
-                    if view not in data:
+                    frames = data.get(view)
+                    if frames is None:
                         continue
                     
-                    # Check frame count and channels
-                    frames = data[view][:]
-                    if len(frames.shape) != 4 or frames.shape[0] < frame_count or frames.shape[3] != 3:
+                    # Check frame count and channels without loading the dataset
+                    if frames.ndim != 4 or frames.shape[0] < frame_count or frames.shape[3] != 3:
                         continue
                     
-                    # Evenly sample frames
+                    # Evenly sample frames, reading only the selected frames from disk.
+                    # One read per frame into a preallocated buffer: h5py fancy indexing is much
+                    # slower on chunked datasets, and per-frame reads benefit from the chunk cache.
                     total_frames = frames.shape[0]
                     indices = np.linspace(0, total_frames-1, frame_count, dtype=int)
-                    selected_frames = frames[indices]
+                    selected_frames = np.empty((frame_count,) + frames.shape[1:], dtype=frames.dtype)
+                    for k, i in enumerate(indices):
+                        frames.read_direct(selected_frames, np.s_[i], np.s_[k])
                     
                     # Generate video filename
                     view_name = view.split('_')[1]  # left, right, top, wrist
@@ -106,13 +142,10 @@ def process_h5_file(h5_path, task_name, output_folder, frame_count=25):
                     fourcc = cv2.VideoWriter_fourcc(*'mp4v')
                     video = cv2.VideoWriter(video_path, fourcc, 10, (width, height))
                     
-                    for frame in selected_frames:
-                        # Resize if necessary
-                        if frame.shape[0] != height or frame.shape[1] != width:
-                            frame = cv2.resize(frame, (width, height))
-                        
-                        # Convert RGB to BGR for OpenCV
-                        bgr_frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+                    # Crop to the even size and convert RGB to BGR for OpenCV in one batch copy
+                    bgr_frames = np.ascontiguousarray(selected_frames[:, :height, :width, ::-1])
+                    
+                    for bgr_frame in bgr_frames:
                         video.write(bgr_frame)
                     
                     video.release()
@@ -122,8 +155,8 @@ def process_h5_file(h5_path, task_name, output_folder, frame_count=25):
                     json_name = f"{base_filename}-{trial}-{view_name}.json"
                     json_path = os.path.join(view_folder, json_name)
                     
-                    with open(json_path, 'w') as json_file:
-                        json.dump({"0": task_name}, json_file)
+                    with open(json_path, 'wb') as json_file:
+                        json_file.write(json_payload)
                     
                     print(f"Saved JSON: {json_path}")
                     
@@ -4,29 +4,76 @@ import h5py
 import numpy as np
 import json
 import cv2
-import glob
 import shutil
 from tqdm import tqdm
 import imageio
+import concurrent.futures
+
+try:
+    import av
+except ImportError:
+    # PyAV is optional; fall back to imageio/OpenCV when it is not installed
+    av = None
+
+def get_inner_workers():
+    """Number of worker processes used per tar file, read from ROBOSET_INNER_WORKERS (default: 1, sequential)"""
+    value = os.environ.get('ROBOSET_INNER_WORKERS', '1')
+    if value == 'auto':
+        return max(os.cpu_count() // 2, 1)
+    try:
+        return max(int(value), 1)
+    except ValueError:
+        return 1
+
+# Directories already created by ensure_dir in this process
+_ensured_dirs = set()
 
 def ensure_dir(directory):
     """Make sure the directory exists, create it if it doesn't"""
-    if not os.path.exists(directory):
-        os.makedirs(directory)
+    if directory in _ensured_dirs:
+        return
+    os.makedirs(directory, exist_ok=True)
+    _ensured_dirs.add(directory)
+
+def open_sequential(path):
+    """Open a file for sequential reading and let the kernel read ahead while we decompress"""
+    # A 4 MiB userland buffer turns tarfile's small 10 KiB reads into few large read syscalls
+    f = open(path, 'rb', buffering=4 * 1024 * 1024)
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    return f
 
 def extract_tarfile(tar_path, extract_to='.'):
-    """Extract tar.gz file to specified directory and return the top level directory name"""
-    with tarfile.open(tar_path, 'r:*') as tar:
-        tar.extractall(path=extract_to)
-    
-    # Get the top level directory name
-    with tarfile.open(tar_path, 'r:*') as tar:
-        top_level_dirs = {member.name.split('/')[0] for member in tar.getmembers() if member.name != '.'}
-        return list(top_level_dirs)[0] if top_level_dirs else None
+    """Extract the .h5 files of a tar.gz file to specified directory and return the top level directory name"""
+    top_level_dir = None
+    # Single streaming pass: extract members and record the top level directory as we go.
+    # Only .h5 files are used downstream, so other payloads are skipped instead of written to disk.
+    with open_sequential(tar_path) as f, tarfile.open(fileobj=f, mode='r|*') as tar:
+        for member in tar:
+            if top_level_dir is None and member.name != '.':
+                top_level_dir = member.name.split('/', 1)[0]
+            if member.isdir() or member.name.endswith('.h5'):
+                tar.extract(member, path=extract_to)
+    
+    # Make sure the top level directory exists even if none of its members were extracted
+    if top_level_dir:
+        os.makedirs(os.path.join(extract_to, top_level_dir), exist_ok=True)
+    return top_level_dir
 
 def find_h5_files(directory):
     """Find all .h5 files in the directory and its subdirectories"""
-    return glob.glob(os.path.join(directory, '**', '*.h5'), recursive=True)
+    # os.scandir gets names and types from the directory listing, without a stat per entry
+    h5_files = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            # Skip hidden entries like glob does (e.g. macOS AppleDouble '._Trial.h5' files)
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                h5_files.extend(find_h5_files(entry.path))
+            elif entry.name.endswith('.h5'):
+                h5_files.append(entry.path)
+    return h5_files
 
 def adjust_dimensions_to_multiple_of_16(frames):
     """Adjust video frame dimensions to be multiples of 16 to ensure compatibility"""
@@ -38,13 +85,43 @@ def adjust_dimensions_to_multiple_of_16(frames):
     if width == new_width and height == new_height:
         return frames
     
-    # Adjust the size of each frame
-    adjusted_frames = []
-    for frame in frames:
-        adjusted_frame = cv2.resize(frame, (new_width, new_height))
-        adjusted_frames.append(adjusted_frame)
+    # Pad the batch with black pixels on the bottom/right instead of resizing;
+    # the new size is at most 15 pixels larger, so no interpolation is needed
+    adjusted_frames = np.zeros((len(frames), new_height, new_width, channels), dtype=frames[0].dtype)
+    adjusted_frames[:, :height, :width] = frames
     
-    return np.array(adjusted_frames)
+    return adjusted_frames
+
+def save_video_with_pyav(frames, output_path, fps=10):
+    """Save video using PyAV, which encodes in-process with libx264 instead of spawning ffmpeg"""
+    if av is None:
+        return False
+    try:
+        # Convert frames to uint8 if they're not already
+        if frames.dtype != np.uint8:
+            frames = (frames * 255).astype(np.uint8)
+        
+        # Adjust dimensions to multiples of 16 to ensure compatibility
+        frames = adjust_dimensions_to_multiple_of_16(frames)
+        height, width = frames[0].shape[:2]
+        
+        with av.open(output_path, mode='w') as container:
+            stream = container.add_stream('libx264', rate=fps)
+            stream.width = width
+            stream.height = height
+            stream.pix_fmt = 'yuv420p'
+            for frame in frames:
+                # RGB to YUV conversion is done by libswscale inside the encoder
+                video_frame = av.VideoFrame.from_ndarray(frame, format='rgb24')
+                for packet in stream.encode(video_frame):
+                    container.mux(packet)
+            # Flush the encoder
+            for packet in stream.encode():
+                container.mux(packet)
+        return True
+    except Exception as e:
+        print(f"Error saving video with PyAV: {e}")
+        return False
 
 def save_video_with_imageio(frames, output_path, fps=10):
     """Save video using imageio which has better compatibility"""
@@ -66,110 +143,157 @@ def save_video_with_imageio(frames, output_path, fps=10):
         print(f"Error saving video with imageio: {e}")
         return False
 
-def process_h5_file(h5_path, task_name, output_folder, frame_count=25, max_pairs=500):
+def save_video_with_opencv(frames, output_path, fps=10):
+    """Save video using OpenCV, used as a fallback when PyAV and imageio fail"""
+    # Make sure dimensions are multiples of 16 for better compatibility
+    height, width = frames[0].shape[:2]
+    new_width = ((width + 15) // 16) * 16
+    new_height = ((height + 15) // 16) * 16
+    
+    # Try H.264 codec if available
+    try:
+        # On macOS, 'avc1' is usually available for H.264
+        fourcc = cv2.VideoWriter_fourcc(*'avc1')
+        video = cv2.VideoWriter(output_path, fourcc, fps, (new_width, new_height))
+    
+        if not video.isOpened():
+            # Fall back to mp4v if avc1 is not available
+            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+            video = cv2.VideoWriter(output_path, fourcc, fps, (new_width, new_height))
+    except:
+        # If H.264 is not available, use mp4v
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        video = cv2.VideoWriter(output_path, fourcc, fps, (new_width, new_height))
+    
+    if not video.isOpened():
+        print(f"Error saving video with OpenCV: could not open writer for {output_path}")
+        return False
+    
+    # Convert RGB to BGR for OpenCV once for the whole batch: the channel swap is a view,
+    # and padding to multiples of 16 copies it into a contiguous array in the same pass
+    bgr_frames = adjust_dimensions_to_multiple_of_16(frames[..., ::-1])
+    if bgr_frames.shape[1:3] == frames.shape[1:3]:
+        # Already aligned, so the helper returned the view unchanged
+        bgr_frames = np.ascontiguousarray(bgr_frames)
+    
+    for bgr_frame in bgr_frames:
+        video.write(bgr_frame)
+    
+    video.release()
+    return True
+
+def views_reached_limit(output_folder, max_pairs=500):
+    """Check whether every view subfolder already holds max_pairs video/json pairs"""
+    for view_dir in ['left', 'right', 'top', 'wrist']:
+        folder = os.path.join(output_folder, view_dir)
+        if not os.path.isdir(folder) or len(os.listdir(folder)) < 2 * max_pairs:
+            return False
+    return True
+
+def process_h5_file(h5_path, task_name, output_folder, frame_count=25, max_pairs=500, shared_output=False):
     """
 Process a single h5 file, extract frames and generate videos.
+    Set shared_output when other processes write to the same output folder concurrently.
     Returns True if processed completely, or False if early termination occurred.
     """    
     base_filename = os.path.basename(h5_path).replace('.h5', '')
+    # Every JSON file of this task has the same content, so encode it once
+    json_payload = json.dumps({"0": task_name}).encode()
+    rgb_views = ['rgb_left', 'rgb_right', 'rgb_top', 'rgb_wrist']
+    
+    # Count existing files per view once; updated as videos are saved
+    counts = {}
+    for view in rgb_views:
+        view_folder = os.path.join(output_folder, view.split('_')[1])
+        ensure_dir(view_folder)
+        counts[view] = len(os.listdir(view_folder))
+    
+    # Don't open the h5 file if there is nothing left to write
+    if all(count >= 2 * max_pairs for count in counts.values()):
+        print("All views reached limit; skipping remaining h5 files.")
+        return False
     
     try:
-        with h5py.File(h5_path, 'r') as file:
+        # Enlarge the chunk cache (default 1 MiB) so chunks of full-resolution frames stay cached
+        # while the sampled frames are read
+        with h5py.File(h5_path, 'r', rdcc_nbytes=256 * 1024 * 1024, rdcc_nslots=1000003, rdcc_w0=0.75) as file:
             # Check for Trial keys
             trials = sorted([k for k in file.keys() if 'Trial' in k], 
                            key=lambda x: int(x.replace('Trial', '')))
             
             for trial in trials:
-                if 'data' not in file[trial]:
+                # Single lookup instead of a membership test followed by indexing
+                data = file[trial].get('data')
+                if data is None:
                     continue
                 
-                data = file[trial]['data']
-                
                 # Check for RGB views
-                rgb_views = ['rgb_left', 'rgb_right', 'rgb_top', 'rgb_wrist']
                 for view in rgb_views:
-                    if view not in data:
+                    frames = data.get(view)
+                    if frames is None:
                         continue
                     
-                    # Check frame count and channels
-                    frames = data[view][:]
-                    if len(frames.shape) != 4 or frames.shape[0] < frame_count or frames.shape[3] != 3:
+                    view_name = view.split('_')[1]  # left, right, top, wrist
+                    
+                    # Other worker processes write to the same folders, so re-list instead of
+                    # trusting the snapshot taken when this file was opened
+                    if shared_output:
+                        counts[view] = len(os.listdir(os.path.join(output_folder, view_name)))
+                    
+                    # Check if the view folder has reached the limit
+                    if counts[view] >= 2 * max_pairs:
+                        print(f"Skipping {view_name}: reached limit ({counts[view]//2} pairs)")
                         continue
                     
-                    # Evenly sample frames
+                    # Check frame count and channels without loading the dataset
+                    if frames.ndim != 4 or frames.shape[0] < frame_count or frames.shape[3] != 3:
+                        continue
+                    
+                    # Evenly sample frames, reading only the selected frames from disk.
+                    # One read per frame into a preallocated buffer: h5py fancy indexing is much
+                    # slower on chunked datasets, and per-frame reads benefit from the chunk cache.
                     total_frames = frames.shape[0]
                     indices = np.linspace(0, total_frames-1, frame_count, dtype=int)
-                    selected_frames = frames[indices]
+                    selected_frames = np.empty((frame_count,) + frames.shape[1:], dtype=frames.dtype)
+                    for k, i in enumerate(indices):
+                        frames.read_direct(selected_frames, np.s_[i], np.s_[k])
                     
                     # Generate video filename
-                    view_name = view.split('_')[1]  # left, right, top, wrist
                     video_name = f"{base_filename}-{trial}-{view_name}.mp4"
                     
                     # Save to the corresponding view subfolder
                     view_folder = os.path.join(output_folder, view_name)
-                    # Make sure the view folder exists
-                    ensure_dir(view_folder)
+                    video_path = os.path.join(view_folder, video_name)
+                    # Overwriting a pair from an earlier run doesn't change the folder's file count
+                    is_new = not os.path.exists(video_path)
                     
-                    # Check if the view folder has reached the limit
-                    existing_files = os.listdir(view_folder)
-                    if len(existing_files) >= 2 * max_pairs:
-                        print(f"Skipping {view_name}: reached limit ({len(existing_files)//2} pairs)")
-                        continue
+                    # Try PyAV first (in-process encoding), then imageio (better compatibility),
+                    # and fall back to OpenCV if both fail
+                    saved = (save_video_with_pyav(selected_frames, video_path)
+                             or save_video_with_imageio(selected_frames, video_path)
+                             or save_video_with_opencv(selected_frames, video_path))
                     
-                    video_path = os.path.join(view_folder, video_name)
+                    # Release the sampled frames before reading the next view
+                    del selected_frames
                     
-                    # Try to save with imageio first (better compatibility)
-                    if save_video_with_imageio(selected_frames, video_path):
-                        # print(f"Saved video with imageio: {video_path}")
-                        pass
-                    else:
-                        # Fallback to OpenCV if imageio fails
-                        # Make sure dimensions are multiples of 16 for better compatibility
-                        height, width = selected_frames[0].shape[:2]
-                        new_width = ((width + 15) // 16) * 16
-                        new_height = ((height + 15) // 16) * 16
-                        
-                        # Try H.264 codec if available
-                        try:
-                            # On macOS, 'avc1' is usually available for H.264
-                            fourcc = cv2.VideoWriter_fourcc(*'avc1')
-                            video = cv2.VideoWriter(video_path, fourcc, 10, (new_width, new_height))
-                            
-                            if not video.isOpened():
-                                # Fall back to mp4v if avc1 is not available
-                                fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-                                video = cv2.VideoWriter(video_path, fourcc, 10, (new_width, new_height))
-                        except:
-                            # If H.264 is not available, use mp4v
-                            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-                            video = cv2.VideoWriter(video_path, fourcc, 10, (new_width, new_height))
-                        
-                        for frame in selected_frames:
-                            # Adjust dimensions to multiples of 16
-                            frame = cv2.resize(frame, (new_width, new_height))
-                            
-                            # Convert RGB to BGR for OpenCV
-                            bgr_frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-                            video.write(bgr_frame)
-                        
-                        video.release()
-                        #print(f"Saved video with OpenCV: {video_path}")
+                    if not saved:
+                        continue
                     
                     # Save corresponding JSON file to the same view subfolder
                     json_name = f"{base_filename}-{trial}-{view_name}.json"
                     json_path = os.path.join(view_folder, json_name)
                     
-                    with open(json_path, 'w') as json_file:
-                        json.dump({"0": task_name}, json_file)
+                    with open(json_path, 'wb') as json_file:
+                        json_file.write(json_payload)
                     
-                    # Check if the view folder has reached the limit
-                all_done = True
-                for view in rgb_views:
-                    view_name = view.split('_')[1]
-                    folder = os.path.join(output_folder, view_name)
-                    if len(os.listdir(folder)) < 2 * max_pairs:
-                        all_done = False
-                        break
+                    if is_new:
+                        counts[view] += 2
+                
+                # Check if all view folders have reached the limit
+                if shared_output:
+                    for view in rgb_views:
+                        counts[view] = len(os.listdir(os.path.join(output_folder, view.split('_')[1])))
+                all_done = all(count >= 2 * max_pairs for count in counts.values())
                 if all_done:
                     print("All views reached limit; skipping remaining h5 files.")
                     return False
@@ -191,6 +315,14 @@ def process_tarfile(tar_path, task_name, output_folder, frame_count=25, max_pair
     for view_dir in view_dirs:
         ensure_dir(os.path.join(output_folder, view_dir))
     
+    # Skip extraction entirely if the task is already complete (e.g. on a re-run)
+    if views_reached_limit(output_folder, max_pairs):
+        print(f"All views reached limit; skipping {tar_path}")
+        if os.path.exists(tar_path):
+            os.remove(tar_path)
+            print(f"Removed {tar_path}")
+        return
+    
     # Extract the tar file
     print(f"Extracting {tar_path}")
     extracted_dir = extract_tarfile(tar_path)
@@ -198,28 +330,42 @@ def process_tarfile(tar_path, task_name, output_folder, frame_count=25, max_pair
     if extracted_dir:
         extracted_path = os.path.join(".", extracted_dir)
         
-        # Find .h5 files
-        h5_files = find_h5_files(extracted_path)
-        
-        if h5_files:
-            print(f"Found {len(h5_files)} h5 files")
+        try:
+            # Find .h5 files
+            h5_files = find_h5_files(extracted_path)
             
-            # Process each h5 file
-            for h5_file in h5_files:
-                cont = process_h5_file(h5_file, task_name, output_folder, frame_count, max_pairs)
-                if not cont:
-                    break
-        else:
-            print("No h5 files found")
-        
-        # Remove extracted folder
-        shutil.rmtree(extracted_path)
-        print(f"Removed {extracted_path}")
-        
-        # Remove tar file
-        if os.path.exists(tar_path):
-            os.remove(tar_path)
-            print(f"Removed {tar_path}")
+            if h5_files:
+                print(f"Found {len(h5_files)} h5 files")
+                
+                inner_workers = min(len(h5_files), get_inner_workers())
+                if inner_workers > 1:
+                    # Process h5 files concurrently; stop submitting once all views are full
+                    print(f"Using {inner_workers} inner worker processes")
+                    with concurrent.futures.ProcessPoolExecutor(max_workers=inner_workers) as executor:
+                        futures = [executor.submit(process_h5_file, h5_file, task_name, output_folder, frame_count, max_pairs,
+                                                   shared_output=True)
+                                   for h5_file in h5_files]
+                        for future in concurrent.futures.as_completed(futures):
+                            if not future.result() or views_reached_limit(output_folder, max_pairs):
+                                executor.shutdown(wait=True, cancel_futures=True)
+                                break
+                else:
+                    # Process each h5 file
+                    for h5_file in h5_files:
+                        cont = process_h5_file(h5_file, task_name, output_folder, frame_count, max_pairs)
+                        if not cont:
+                            break
+            else:
+                print("No h5 files found")
+        finally:
+            # Remove extracted folder, even if processing failed (e.g. a worker process died)
+            shutil.rmtree(extracted_path)
+            print(f"Removed {extracted_path}")
+            
+            # Remove tar file
+            if os.path.exists(tar_path):
+                os.remove(tar_path)
+                print(f"Removed {tar_path}")
     else:
         print("Failed to extract directory")
 